@@ -1,12 +1,14 @@
 from datasets import load_dataset, DatasetDict
-from typing import Dict, List
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from lingua.tokenizer import Tokenizer
 from .tokenizer import MisakiTokenizer, DacTokenizer, create_dac_tokenizer_model
 import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, Sampler
 from pathlib import Path
 from torch.nn.utils.rnn import pad_sequence
+import json
 import logging
+import math
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -15,13 +17,83 @@ logging.basicConfig(
 
 
 class TTSDataset(Dataset):
-    def __init__(self, split: str, data_dir: Path):
+    LENGTHS_CACHE = "lengths.json"
+
+    def __init__(self, split: str, data_dir: Path, use_length_cache: bool = False):
         self.data_dir = data_dir / split
-        self.file_paths = list(self.data_dir.glob("*.pt"))
+        if use_length_cache:
+            # Skip listing the directory, files follow save_to_pt_files' naming
+            length = self.cached_length(split, data_dir)
+            self.file_paths = [
+                self.data_dir / f"sample_{idx}.pt" for idx in range(length)
+            ]
+        else:
+            self.file_paths = list(self.data_dir.glob("*.pt"))
+        self._sample_lengths: Optional[List[int]] = None
 
     def __len__(self):
         return len(self.file_paths)
 
+    @staticmethod
+    def length_cache_path(split: str, data_dir: Path) -> Path:
+        return data_dir / f"{split}_len.txt"
+
+    @classmethod
+    def cached_length(cls, split: str, data_dir: Path) -> int:
+        """
+        Number of samples in a split without listing its directory, read from
+        `<data_dir>/<split>_len.txt`. The file is written by `save_to_pt_files`,
+        or on the first call if it is missing.
+        """
+        cache_path = cls.length_cache_path(split, data_dir)
+        if cache_path.exists():
+            return int(cache_path.read_text())
+
+        return cls.refresh_length_cache(split, data_dir)
+
+    @classmethod
+    def refresh_length_cache(cls, split: str, data_dir: Path) -> int:
+        """
+        List the split once, check the files are named as `save_to_pt_files`
+        writes them and rewrite the length cache. Meant to run on a single rank
+        before the others build the dataset with `use_length_cache=True`.
+        """
+        file_names = {path.name for path in (data_dir / split).glob("*.pt")}
+        expected_names = {f"sample_{idx}.pt" for idx in range(len(file_names))}
+        if file_names != expected_names:
+            raise ValueError(
+                f"Samples in {data_dir / split} should be named sample_0.pt to sample_{len(file_names) - 1}.pt, as written by save_to_pt_files"
+            )
+
+        cls.length_cache_path(split, data_dir).write_text(str(len(file_names)))
+        return len(file_names)
+
+    def sample_lengths(self) -> List[int]:
+        """
+        Total (text + audio) token length of every sample, in dataset order.
+        Lengths are cached to disk after the first scan of the split.
+        """
+        if self._sample_lengths is not None:
+            return self._sample_lengths
+
+        cache_path = self.data_dir / self.LENGTHS_CACHE
+        cached: Dict[str, int] = {}
+        if cache_path.exists():
+            with open(cache_path) as f:
+                cached = json.load(f)
+
+        missing = [path for path in self.file_paths if path.name not in cached]
+        for path in missing:
+            data = torch.load(path, weights_only=False)
+            cached[path.name] = len(data["text_tokens"]) + data["audio_tokens"].shape[1]
+
+        if missing:
+            with open(cache_path, "w") as f:
+                json.dump(cached, f)
+
+        self._sample_lengths = [cached[path.name] for path in self.file_paths]
+        return self._sample_lengths
+
     def __getitem__(self, idx):
         data = torch.load(self.file_paths[idx], weights_only=False)
         return {
@@ -56,13 +128,124 @@ class TTSCollator:
         audio_mask = (audio_padded != self.audio_pad_id).any(dim=1)
         combined_mask = torch.cat([text_mask, audio_mask], dim=1).bool()
 
-        return {
-            "text_tokens": text_padded,
-            "audio_tokens": audio_padded,
-            "attention_mask": combined_mask,
-            "texts": [sample["text"] for sample in batch],
-            "audio": [sample["audio"] for sample in batch],
-        }
+        # Only the packed buffer is returned, so each batch is serialized from the
+        # worker and pinned once. The audio shift is done here instead of per step.
+        packed, packed_layout = pack_tensors(
+            {
+                "text_tokens": text_padded,
+                "audio_input": audio_padded[:, :, :-1],
+                "audio_target": audio_padded[:, :, 1:],
+                "input_mask": combined_mask[:, :-1],
+            }
+        )
+
+        return {"packed": packed, "packed_layout": packed_layout}
+
+
+def pack_tensors(
+    tensors: Dict[str, torch.Tensor],
+) -> Tuple[torch.Tensor, List[Tuple[str, Tuple[int, ...], torch.dtype]]]:
+    """
+    Flatten integer/bool tensors into a single int32 buffer so they can be moved
+    to the GPU with one copy. Returns the buffer and the layout needed by
+    `unpack_tensors` to restore the original dtypes on the GPU.
+
+    Token ids fit in int32, which halves the copy compared to int64. The bool
+    mask is widened 4x, but it is 1/(1 + 2 * num_quantizers) of the elements,
+    which is cheaper than issuing a second copy for it.
+    """
+    layout = [
+        (name, tuple(tensor.shape), tensor.dtype) for name, tensor in tensors.items()
+    ]
+    packed = torch.cat(
+        [tensor.reshape(-1).to(torch.int32) for tensor in tensors.values()]
+    )
+    return packed, layout
+
+
+def unpack_tensors(
+    packed: torch.Tensor, layout: List[Tuple[str, Any, torch.dtype]]
+) -> Dict[str, torch.Tensor]:
+    sizes = [math.prod(shape) for _, shape, _ in layout]
+    return {
+        name: chunk.view(*shape).to(dtype)
+        for (name, shape, dtype), chunk in zip(layout, packed.split(sizes))
+    }
+
+
+class DistributedLengthBucketSampler(Sampler[List[int]]):
+    """
+    Batch sampler that groups samples of similar length to reduce padding.
+
+    Indices are shuffled, split into pools of `pool_size` batches per replica,
+    sorted by length within each pool and cut into batches. The batch order is
+    then shuffled and the batches are split evenly across replicas.
+    """
+
+    def __init__(
+        self,
+        lengths: List[int],
+        batch_size: int,
+        num_replicas: int,
+        rank: int,
+        pool_size: int = 100,
+        shuffle: bool = True,
+        seed: int = 0,
+    ):
+        assert 0 <= rank < num_replicas, (
+            f"Invalid rank {rank}, should be in [0, {num_replicas - 1}]"
+        )
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.pool_size = pool_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _create_batches(self) -> List[List[int]]:
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        if self.shuffle:
+            indices = torch.randperm(len(self.lengths), generator=generator).tolist()
+        else:
+            indices = list(range(len(self.lengths)))
+
+        pool_len = self.batch_size * self.pool_size * self.num_replicas
+        batches = []
+        for start in range(0, len(indices), pool_len):
+            pool = sorted(
+                indices[start : start + pool_len], key=lambda i: self.lengths[i]
+            )
+            batches.extend(
+                pool[i : i + self.batch_size]
+                for i in range(0, len(pool), self.batch_size)
+            )
+
+        if self.shuffle:
+            order = torch.randperm(len(batches), generator=generator).tolist()
+            batches = [batches[i] for i in order]
+
+        # Pad by repeating batches so every replica gets the same number of steps
+        total_size = len(self) * self.num_replicas
+        if batches:
+            batches += (batches * math.ceil(total_size / len(batches)))[
+                : total_size - len(batches)
+            ]
+
+        return batches
+
+    def __iter__(self) -> Iterator[List[int]]:
+        return iter(self._create_batches()[self.rank :: self.num_replicas])
+
+    def __len__(self) -> int:
+        num_batches = math.ceil(len(self.lengths) / self.batch_size)
+        return math.ceil(num_batches / self.num_replicas)
 
 
 def filter_empty_audio(dataset: DatasetDict) -> DatasetDict:
@@ -137,9 +320,13 @@ def save_to_pt_files(dataset: DatasetDict, splits: List[str], data_dir: Path):
         (data_dir / split).mkdir(parents=True, exist_ok=True)
 
     for split in splits:
+        sample_lengths: Dict[str, int] = {}
         for idx, sample in enumerate(dataset[split]):
             text_tokens = torch.tensor(sample["text_tokens"], dtype=torch.long)
             audio_tokens = torch.tensor(sample["audio_tokens"], dtype=torch.long)
+            sample_lengths[f"sample_{idx}.pt"] = (
+                len(text_tokens) + audio_tokens.shape[1]
+            )
 
             torch.save(
                 {
@@ -152,6 +339,13 @@ def save_to_pt_files(dataset: DatasetDict, splits: List[str], data_dir: Path):
                 data_dir / split / f"sample_{idx}.pt",
             )
 
+        # Rewrite both caches so regenerated files are never matched to stale entries
+        with open(data_dir / split / TTSDataset.LENGTHS_CACHE, "w") as f:
+            json.dump(sample_lengths, f)
+        TTSDataset.length_cache_path(split, data_dir).write_text(
+            str(len(dataset[split]))
+        )
+
 
 def get_max_lengths(dataset: Dataset):
     max_text_len = 0
@@ -229,9 +423,10 @@ def main():
     # Sanity check
     for batch_indx, batch in enumerate(train_loader):
         if batch_indx % 1000 == 0:
+            batch = unpack_tensors(batch["packed"], batch["packed_layout"])
             print("Text tokens shape:", batch["text_tokens"].shape)
-            print("Audio tokens shape:", batch["audio_tokens"].shape)
-            print("Attention mask shape:", batch["attention_mask"].shape)
+            print("Audio input shape:", batch["audio_input"].shape)
+            print("Input mask shape:", batch["input_mask"].shape)
 
 
 if __name__ == "__main__":
@@ -7,6 +7,7 @@ from typing import Optional, Union, Tuple
 import torch
 from torch import nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 from xformers.ops import fmha, AttentionBias
 from torch.nn.attention.flex_attention import (
     BlockMask,
@@ -567,6 +568,9 @@ class BaseTransformer(nn.Module):
         for _ in range(args.n_layers):
             self.layers.append(TransformerBlock(args))
 
+        # Recompute block activations in backward instead of storing them
+        self.use_ckpt = False
+
     def forward(
         self,
         h,
@@ -580,7 +584,18 @@ class BaseTransformer(nn.Module):
         freq_cis = self.rope_embeddings(seqlen=seq_len, tok_idx=tok_idx, device=device)
 
         for i, layer in enumerate(self.layers):
-            h = layer(h, freq_cis, tok_idx=tok_idx, mask=mask, attn_impl=attn_impl)
+            if self.training and self.use_ckpt:
+                h = checkpoint(
+                    layer,
+                    h,
+                    freq_cis,
+                    tok_idx=tok_idx,
+                    mask=mask,
+                    attn_impl=attn_impl,
+                    use_reentrant=False,
+                )
+            else:
+                h = layer(h, freq_cis, tok_idx=tok_idx, mask=mask, attn_impl=attn_impl)
         return h
 
     def reset_parameters(self):
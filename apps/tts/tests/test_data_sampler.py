@@ -0,0 +1,60 @@
+import pytest
+
+from ..data import DistributedLengthBucketSampler
+
+
+@pytest.fixture
+def lengths():
+    return [(i * 37) % 101 + 1 for i in range(50)]
+
+
+def test_sampler_covers_all_indices(lengths):
+    sampler = DistributedLengthBucketSampler(
+        lengths, batch_size=4, num_replicas=1, rank=0, pool_size=2
+    )
+
+    indices = [i for batch in sampler for i in batch]
+    assert sorted(indices) == list(range(len(lengths))), (
+        "Every sample should appear exactly once for a single replica"
+    )
+    assert len(list(sampler)) == len(sampler)
+
+
+def test_sampler_batches_are_sorted_within_pool(lengths):
+    sampler = DistributedLengthBucketSampler(
+        lengths, batch_size=5, num_replicas=1, rank=0, pool_size=len(lengths)
+    )
+
+    batches = sorted(list(sampler), key=lambda batch: lengths[batch[0]])
+    flat_lengths = [lengths[i] for batch in batches for i in batch]
+    assert flat_lengths == sorted(lengths), (
+        "With a single pool, batches should hold contiguous runs of sorted lengths"
+    )
+
+
+def test_sampler_replicas_get_equal_disjoint_batches(lengths):
+    num_replicas = 3
+    samplers = [
+        DistributedLengthBucketSampler(
+            lengths, batch_size=4, num_replicas=num_replicas, rank=rank, pool_size=2
+        )
+        for rank in range(num_replicas)
+    ]
+
+    per_rank = [list(sampler) for sampler in samplers]
+    assert all(len(batches) == len(samplers[0]) for batches in per_rank)
+
+    seen = {i for batches in per_rank for batch in batches for i in batch}
+    assert seen == set(range(len(lengths)))
+
+
+def test_sampler_set_epoch_changes_order(lengths):
+    sampler = DistributedLengthBucketSampler(
+        lengths, batch_size=4, num_replicas=1, rank=0, pool_size=2
+    )
+
+    first_epoch = list(sampler)
+    assert list(sampler) == first_epoch, "Order should be deterministic per epoch"
+
+    sampler.set_epoch(1)
+    assert list(sampler) != first_epoch
@@ -3,7 +3,13 @@ import torch
 from datasets import DatasetDict
 import shutil
 import numpy as np
-from ..data import save_to_pt_files, TTSDataset, TTSCollator
+from ..data import (
+    pack_tensors,
+    save_to_pt_files,
+    TTSDataset,
+    TTSCollator,
+    unpack_tensors,
+)
 
 
 @pytest.fixture
@@ -152,6 +158,73 @@ def test_tts_dataset_getitem(dataset_on_disk):
     assert sample["sampling_rate"] == 16000
 
 
+def test_tts_dataset_sample_lengths(dataset_on_disk):
+    dataset = TTSDataset("train", dataset_on_disk)
+
+    assert dataset.sample_lengths() == [6], "Length should be text (3) + audio (3)"
+    assert (dataset_on_disk / "train" / TTSDataset.LENGTHS_CACHE).exists()
+
+    cached_dataset = TTSDataset("train", dataset_on_disk)
+    assert cached_dataset.sample_lengths() == [6]
+
+
+def test_save_to_pt_files_rewrites_sample_lengths(dataset_on_disk):
+    assert TTSDataset("train", dataset_on_disk).sample_lengths() == [6]
+
+    regenerated = DatasetDict(
+        {
+            "train": [
+                {
+                    "text_tokens": [1, 2],
+                    "audio_tokens": [[4, 5, 6, 7, 8], [9, 10, 11, 12, 13]],
+                    "text": "hello",
+                    "audio": {
+                        "array": np.array([0.1, 0.2]),
+                        "sampling_rate": 16000,
+                    },
+                }
+            ]
+        }
+    )
+    save_to_pt_files(regenerated, ["train"], dataset_on_disk)
+
+    assert TTSDataset("train", dataset_on_disk).sample_lengths() == [7], (
+        "Lengths cache should be rewritten with text (2) + audio (5)"
+    )
+
+
+def test_tts_dataset_cached_length(dataset_on_disk):
+    cache_path = TTSDataset.length_cache_path("train", dataset_on_disk)
+    assert cache_path.exists(), "save_to_pt_files should write the length cache"
+    assert TTSDataset.cached_length("train", dataset_on_disk) == 1
+
+    cache_path.unlink()
+    assert TTSDataset.cached_length("train", dataset_on_disk) == 1
+    assert cache_path.read_text() == "1"
+
+
+def test_tts_dataset_use_length_cache(dataset_on_disk):
+    dataset = TTSDataset("train", dataset_on_disk, use_length_cache=True)
+
+    assert len(dataset) == 1
+    assert dataset.file_paths == [dataset_on_disk / "train" / "sample_0.pt"]
+    assert torch.equal(dataset[0]["text_tokens"], torch.tensor([1, 2, 3]))
+
+
+def test_tts_dataset_refresh_length_cache(dataset_on_disk):
+    cache_path = TTSDataset.length_cache_path("train", dataset_on_disk)
+    cache_path.write_text("5")
+
+    assert TTSDataset.refresh_length_cache("train", dataset_on_disk) == 1
+    assert cache_path.read_text() == "1", "Stale length cache should be rewritten"
+
+    (dataset_on_disk / "train" / "sample_0.pt").rename(
+        dataset_on_disk / "train" / "sample_3.pt"
+    )
+    with pytest.raises(ValueError):
+        TTSDataset.refresh_length_cache("train", dataset_on_disk)
+
+
 def test_tts_collator():
     text_pad_id = audio_pad_id = 0
     collator = TTSCollator(text_pad_id, audio_pad_id)
@@ -176,17 +249,64 @@ def test_tts_collator():
     collated = collator(batch)
 
     assert isinstance(collated, dict)
-    assert "text_tokens" in collated
-    assert "audio_tokens" in collated
+    assert set(collated) == {"packed", "packed_layout"}, (
+        "Collator should only return the packed buffer and its layout"
+    )
+
+    unpacked = unpack_tensors(collated["packed"], collated["packed_layout"])
+    assert set(unpacked) == {"text_tokens", "audio_input", "audio_target", "input_mask"}
+
+    assert unpacked["text_tokens"].shape == (2, 3)
+    assert unpacked["audio_input"].shape == (2, 2, 2)
+    assert unpacked["audio_target"].shape == (2, 2, 2)
+    assert unpacked["input_mask"].shape == (2, 5)
+
+    assert unpacked["text_tokens"].dtype == torch.long
+    assert unpacked["audio_input"].dtype == torch.long
+    assert unpacked["audio_target"].dtype == torch.long
+    assert unpacked["input_mask"].dtype == torch.bool
+
+    assert torch.equal(unpacked["text_tokens"][0], torch.tensor([1, 2, 3]))
+    assert torch.equal(unpacked["text_tokens"][1], torch.tensor([10, 11, 0]))
+
+
+def test_tts_collator_shifted_audio():
+    text_pad_id = audio_pad_id = 0
+    collator = TTSCollator(text_pad_id, audio_pad_id)
+
+    batch = [
+        {
+            "text_tokens": torch.tensor([1, 2], dtype=torch.long),
+            "audio_tokens": torch.tensor([[4, 5, 6], [7, 8, 9]], dtype=torch.long),
+            "text": "hello world",
+            "audio": np.array([0.1, 0.2, 0.3]),
+            "sampling_rate": 16000,
+        }
+    ]
+
+    collated = collator(batch)
+    unpacked = unpack_tensors(collated["packed"], collated["packed_layout"])
+
+    assert torch.equal(unpacked["audio_input"], torch.tensor([[[4, 5], [7, 8]]]))
+    assert torch.equal(unpacked["audio_target"], torch.tensor([[[5, 6], [8, 9]]]))
+    assert torch.equal(unpacked["input_mask"], torch.tensor([[True, True, True, True]]))
+
 
-    assert collated["text_tokens"].shape == (2, 3)
-    assert collated["audio_tokens"].shape == (2, 2, 3)
+def test_pack_tensors_round_trip():
+    tensors = {
+        "tokens": torch.tensor([[1, 2, 3], [4, 5, 6]], dtype=torch.long),
+        "mask": torch.tensor([True, False, True]),
+    }
 
-    assert collated["text_tokens"].dtype == torch.long
-    assert collated["audio_tokens"].dtype == torch.long
+    packed, layout = pack_tensors(tensors)
+    unpacked = unpack_tensors(packed, layout)
 
-    assert torch.equal(collated["text_tokens"][0], torch.tensor([1, 2, 3]))
-    assert torch.equal(collated["text_tokens"][1], torch.tensor([10, 11, 0]))
+    assert packed.dim() == 1
+    assert packed.dtype == torch.int32
+    assert set(unpacked) == set(tensors)
+    for name, tensor in tensors.items():
+        assert unpacked[name].dtype == tensor.dtype
+        assert torch.equal(unpacked[name], tensor), f"{name} mismatch"
 
 
 def test_tts_collator_empty_batch():
@@ -0,0 +1,106 @@
+import contextlib
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from ..train import _to_cpu, wrap_ddp
+from ..transformer import TTSTransformer, TTSTransformerArgs
+
+WORLD_SIZE = 2
+GRAD_ACCUM_STEPS = 2
+
+
+def _create_model() -> TTSTransformer:
+    torch.manual_seed(0)
+    args = TTSTransformerArgs(
+        dim=32,
+        n_layers=2,
+        n_heads=4,
+        text_vocab_size=20,
+        audio_vocab_size=30,
+        num_quantizers=3,
+        max_seqlen=64,
+        use_ckpt=True,
+    )
+    return TTSTransformer(args)
+
+
+def _create_micro_batches():
+    generator = torch.Generator().manual_seed(1)
+    batches = []
+    for _ in range(WORLD_SIZE * GRAD_ACCUM_STEPS):
+        text_tokens = torch.randint(0, 20, (2, 3), generator=generator)
+        audio_tokens = torch.randint(1, 30, (2, 3, 5), generator=generator)
+        batches.append((text_tokens, audio_tokens[:, :, :-1], audio_tokens[:, :, 1:]))
+    return batches
+
+
+def _ddp_accumulation_worker(rank: int, store_path: str, output_path: str):
+    dist.init_process_group(
+        "gloo",
+        init_method=f"file://{store_path}",
+        rank=rank,
+        world_size=WORLD_SIZE,
+    )
+    try:
+        model = wrap_ddp(_create_model().train(), torch.device("cpu"))
+        micro_batches = _create_micro_batches()[rank::WORLD_SIZE]
+
+        # Two optimizer-free "steps" so a broken reducer state surfaces on the second
+        for _ in range(2):
+            model.zero_grad(set_to_none=True)
+            for step, (text_tokens, audio_input, audio_target) in enumerate(
+                micro_batches
+            ):
+                is_sync_step = (step + 1) % GRAD_ACCUM_STEPS == 0
+                sync_context = (
+                    contextlib.nullcontext() if is_sync_step else model.no_sync()
+                )
+                with sync_context:
+                    loss, _ = model(text_tokens, audio_input, target=audio_target)
+                    (loss / GRAD_ACCUM_STEPS).backward()
+
+        if rank == 0:
+            torch.save(
+                {
+                    name: param.grad.clone()
+                    for name, param in model.module.named_parameters()
+                },
+                output_path,
+            )
+    finally:
+        dist.destroy_process_group()
+
+
+def test_ddp_gradient_accumulation_matches_single_process(tmp_path):
+    output_path = tmp_path / "ddp_grads.pt"
+    mp.spawn(
+        _ddp_accumulation_worker,
+        args=(str(tmp_path / "store"), str(output_path)),
+        nprocs=WORLD_SIZE,
+    )
+    ddp_grads = torch.load(output_path)
+
+    reference = _create_model().train()
+    for text_tokens, audio_input, audio_target in _create_micro_batches():
+        loss, _ = reference(text_tokens, audio_input, target=audio_target)
+        (loss / (GRAD_ACCUM_STEPS * WORLD_SIZE)).backward()
+
+    for name, param in reference.named_parameters():
+        assert torch.allclose(ddp_grads[name], param.grad, atol=1e-5), (
+            f"Param '{name}' gradient differs between DDP accumulation and reference."
+        )
+
+
+def test_to_cpu_copies_cpu_tensors():
+    step = torch.tensor(1.0)
+    state = {"state": {0: {"step": step}}, "param_groups": [{"lr": 1e-3}]}
+
+    snapshot = _to_cpu(state)
+    step += 1
+
+    assert snapshot["state"][0]["step"].item() == 1.0, (
+        "Snapshot should not follow in-place updates of the live optimizer state"
+    )
+    assert snapshot["param_groups"] == [{"lr": 1e-3}]
@@ -4,6 +4,7 @@ import pytest
 import torch
 from torch import nn
 
+from .. import lingua_transformer_modified
 from ..transformer import TTSTransformer, TTSTransformerArgs
 
 
@@ -122,3 +123,69 @@ def test_transformer_training(transformer: TTSTransformer):
             assert param.grad is not None, (
                 f"Param '{name}' got no gradients after backward."
             )
+
+
+def test_transformer_training_with_activation_checkpointing(
+    transformer: TTSTransformer, monkeypatch: pytest.MonkeyPatch
+):
+    device = next(transformer.parameters()).device
+    transformer.train()
+
+    batch_size = 2
+    num_quantizers = transformer.num_quantizers
+    audio_vocab_size = transformer.audio_vocab_size
+
+    text_tokens = torch.randint(
+        low=0,
+        high=transformer.text_vocab_size,
+        size=(batch_size, 3),
+        device=device,
+        dtype=torch.long,
+    )
+    audio_tokens = torch.randint(
+        low=0,
+        high=audio_vocab_size,
+        size=(batch_size, num_quantizers, 4),
+        device=device,
+        dtype=torch.long,
+    )
+    target = torch.randint(
+        low=1,
+        high=audio_vocab_size,
+        size=(batch_size, num_quantizers, 4),
+        device=device,
+        dtype=torch.long,
+    )
+
+    def compute_grads():
+        transformer.zero_grad(set_to_none=True)
+        loss, _ = transformer(text_tokens, audio_tokens, target=target)
+        loss.backward()
+        return {
+            name: param.grad.detach().clone()
+            for name, param in transformer.named_parameters()
+        }
+
+    transformer.use_ckpt = False
+    reference_grads = compute_grads()
+
+    checkpoint_calls = 0
+    original_checkpoint = lingua_transformer_modified.checkpoint
+
+    def counting_checkpoint(*args, **kwargs):
+        nonlocal checkpoint_calls
+        checkpoint_calls += 1
+        return original_checkpoint(*args, **kwargs)
+
+    monkeypatch.setattr(lingua_transformer_modified, "checkpoint", counting_checkpoint)
+
+    transformer.use_ckpt = True
+    ckpt_grads = compute_grads()
+
+    assert checkpoint_calls == len(transformer.layers), (
+        f"Expected {len(transformer.layers)} checkpointed blocks, got {checkpoint_calls}."
+    )
+    for name, grad in reference_grads.items():
+        assert torch.allclose(ckpt_grads[name], grad, atol=1e-6), (
+            f"Param '{name}' gradient differs with activation checkpointing."
+        )
@@ -1,8 +1,11 @@
+import contextlib
 import logging
+import math
 import os
-from dataclasses import dataclass
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import torch
 import torch.distributed as dist
@@ -13,7 +16,12 @@ from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 from torch.amp import GradScaler
 
-from .data import TTSCollator, TTSDataset
+from .data import (
+    DistributedLengthBucketSampler,
+    TTSCollator,
+    TTSDataset,
+    unpack_tensors,
+)
 from .tokenizer import DacTokenizer, MisakiTokenizer, create_dac_tokenizer_model
 from .transformer import TTSTransformer, TTSTransformerArgs
 
@@ -38,9 +46,15 @@ class TrainingConfig:
     audio_pad_id: int = 0
 
     num_workers: int = 4
+    bucket_pool_size: int = 100
     seed: int = 42
     backend: str = "nccl"
 
+    compile: bool = True
+    compile_cache_size_limit: int = 16
+    # Recomputes block activations in backward; pair it with a larger batch_size
+    activation_checkpointing: bool = False
+
     checkpoint_freq: int = 1
     validation_freq: int = 1
     validation_epoch_logger_freq: int = 100
@@ -66,16 +80,20 @@ class CheckpointState:
     config: TrainingConfig
 
     def save(self, path: Path):
-        torch.save(
-            {
-                "model_state": self.model_state,
-                "optimizer_state": self.optimizer_state,
-                "scheduler_state": self.scheduler_state,
-                "trainer_state": self.trainer_state,
-                "config": self.config,
-            },
-            path,
-        )
+        # Write to a temporary file first so a crash never leaves a partial checkpoint
+        tmp_path = path.with_suffix(path.suffix + ".tmp")
+        with open(tmp_path, "wb") as f:
+            torch.save(
+                {
+                    "model_state": self.model_state,
+                    "optimizer_state": self.optimizer_state,
+                    "scheduler_state": self.scheduler_state,
+                    "trainer_state": self.trainer_state,
+                    "config": self.config,
+                },
+                f,
+            )
+        os.replace(tmp_path, path)
 
     @classmethod
     def load(cls, path: Path, device: torch.device) -> "CheckpointState":
@@ -91,70 +109,116 @@ class CheckpointState:
 
 class DistributedTTSTrainer:
     def __init__(
-        self, config: TrainingConfig, model: torch.nn.Module, device: torch.device
+        self,
+        config: TrainingConfig,
+        model: torch.nn.Module,
+        device: torch.device,
+        amp_dtype: torch.dtype = torch.bfloat16,
     ):
         self.config: TrainingConfig = config
         self.device = device
         self.is_main = dist.get_rank() == 0
 
-        self.model = DDP(
-            model.to(device), device_ids=[device.index], output_device=device.index
-        )
+        if self.config.compile:
+            self._compile_blocks(model)
+
+        self.model = wrap_ddp(model, device)
         self.optimizer: Optimizer = self._create_optimizer()
         self.train_loader, self.val_loader = self._create_dataloaders()
         self.scheduler = self._create_scheduler()
 
         self.state = TrainerState()
-        self.scaler = GradScaler()
+        self.checkpoint_executor = ThreadPoolExecutor(max_workers=1)
+        self.checkpoint_future: Optional[Future] = None
+        # FP16 needs loss scaling to avoid gradient underflow, BF16 does not
+        self.amp_dtype = amp_dtype
+        self.scaler = GradScaler(enabled=self.amp_dtype == torch.float16)
         if self.config.resume_checkpoint:
             self.load_checkpoint()
 
+    def _compile_blocks(self, model: torch.nn.Module):
+        # Regional compilation: every TransformerBlock has the same structure, so
+        # the compiled artifact is reused across layers. Compiled in place so the
+        # state_dict keys stay unchanged. reduce-overhead (CUDA graphs) is avoided
+        # since it conflicts with DDP and variable sequence lengths.
+        # Batches are padded to their own max length, so nearly every batch has a
+        # new sequence length. Leaving `dynamic` unset lets Dynamo recompile once
+        # with the changed dims marked dynamic, instead of specializing on every
+        # length until cache_size_limit is exhausted.
+        torch._dynamo.config.cache_size_limit = self.config.compile_cache_size_limit
+        for layer in model.layers:
+            layer.compile(mode="default", fullgraph=True, dynamic=None)
+
     def _create_optimizer(self):
         if self.config.optimizer == "AdamW":
-            return AdamW(self.model.parameters(), lr=self.config.learning_rate)
+            adamw_kwargs = dict(
+                lr=self.config.learning_rate,
+                betas=(0.9, 0.95),
+                capturable=False,
+            )
+            try:
+                return AdamW(self.model.parameters(), fused=True, **adamw_kwargs)
+            except (RuntimeError, TypeError):
+                logger.warning("Fused AdamW unavailable, falling back to foreach")
+                return AdamW(self.model.parameters(), foreach=True, **adamw_kwargs)
         else:
-            return NotImplementedError(
+            raise NotImplementedError(
                 f"Optimizer: {self.config.optimizer} not implemented!"
             )
 
     def _create_scheduler(self):
         if self.config.lr_scheduler == "OneCycleLR":
+            # The dataset length comes from the validated cache, so this is O(1)
+            # and always matches the batches the sampler yields
             return torch.optim.lr_scheduler.OneCycleLR(
                 self.optimizer,
                 max_lr=self.config.max_learning_rate,
                 total_steps=self.config.epochs
-                * (
-                    (len(self.train_loader) + self.config.grad_accum_steps - 1)
-                    // self.config.grad_accum_steps
-                ),
+                * math.ceil(len(self.train_loader) / self.config.grad_accum_steps),
             )
         else:
-            return NotImplementedError(
+            raise NotImplementedError(
                 f"lr_scheduler:{self.config.lr_scheduler} not implemented!"
             )
 
     def _create_dataloaders(self):
         collator_fn = TTSCollator(self.config.text_pad_id, self.config.audio_pad_id)
 
-        train_dataset = TTSDataset("train", self.config.data_dir)
-        train_sampler = DistributedSampler(
-            train_dataset,
+        # Rank 0 lists each split once and refreshes the caches, the other ranks
+        # build their datasets from the caches without touching the filesystem
+        if self.is_main:
+            for split in ("train", "validation"):
+                TTSDataset.refresh_length_cache(split, self.config.data_dir)
+        dist.barrier()
+
+        train_dataset = TTSDataset("train", self.config.data_dir, use_length_cache=True)
+        # Rank 0 fills lengths.json first so the other ranks only read it
+        if self.is_main:
+            train_dataset.sample_lengths()
+        dist.barrier()
+
+        train_sampler = DistributedLengthBucketSampler(
+            train_dataset.sample_lengths(),
+            batch_size=self.config.batch_size,
             num_replicas=dist.get_world_size(),
             rank=dist.get_rank(),
+            pool_size=self.config.bucket_pool_size,
             shuffle=True,
+            seed=self.config.seed,
         )
 
         train_loader = DataLoader(
             train_dataset,
-            batch_size=self.config.batch_size,
-            sampler=train_sampler,
+            batch_sampler=train_sampler,
             collate_fn=collator_fn,
             num_workers=self.config.num_workers,
             pin_memory=True,
             persistent_workers=True,
         )
 
-        val_dataset = TTSDataset("validation", self.config.data_dir)
+        val_dataset = TTSDataset(
+            "validation", self.config.data_dir, use_length_cache=True
+        )
         val_sampler = DistributedSampler(
             val_dataset,
             num_replicas=dist.get_world_size(),
@@ -168,6 +232,7 @@ class DistributedTTSTrainer:
             collate_fn=collator_fn,
             num_workers=self.config.num_workers,
             pin_memory=True,
+            persistent_workers=True,
             drop_last=False,
         )
 
@@ -177,90 +242,183 @@ class DistributedTTSTrainer:
         if not self.is_main:
             return
 
+        # Only one checkpoint write may be in flight at a time
+        self.wait_for_checkpoint()
+
         checkpoint = CheckpointState(
-            model_state=self.model.module.state_dict(),
-            optimizer_state=self.optimizer.state_dict(),
+            model_state=_to_cpu(self.model.module.state_dict()),
+            optimizer_state=_to_cpu(self.optimizer.state_dict()),
             scheduler_state=self.scheduler.state_dict() if self.scheduler else None,
-            trainer_state=self.state,
+            trainer_state=replace(self.state),
             config=self.config,
         )
+        # The copies above are non-blocking; make sure they landed before handing off
+        torch.cuda.current_stream(self.device).synchronize()
 
         filename = f"checkpoint_{self.state.epoch:04d}.pt" if not best else "best.pt"
         path = self.config.checkpoint_dir / filename
+        self.checkpoint_future = self.checkpoint_executor.submit(
+            self._write_checkpoint, checkpoint, path
+        )
+
+    @staticmethod
+    def _write_checkpoint(checkpoint: CheckpointState, path: Path):
         checkpoint.save(path)
         logger.info(f"Saved checkpoint to {path}")
 
+    def wait_for_checkpoint(self):
+        if self.checkpoint_future is not None:
+            self.checkpoint_future.result()
+            self.checkpoint_future = None
+
     def load_checkpoint(self):
-        checkpoint = CheckpointState.load(self.config.resume_checkpoint, self.device)
+        # Only rank 0 reads from disk, the other ranks receive the state by broadcast
+        checkpoint = (
+            CheckpointState.load(self.config.resume_checkpoint, self.device)
+            if self.is_main
+            else None
+        )
+        states = self._broadcast_from_main(
+            {
+                "model_state": checkpoint.model_state,
+                "optimizer_state": checkpoint.optimizer_state,
+                "scheduler_state": checkpoint.scheduler_state,
+            }
+            if checkpoint is not None
+            else None
+        )
 
-        self.model.module.load_state_dict(checkpoint.model_state)
-        self.optimizer.load_state_dict(checkpoint.optimizer_state)
+        self.model.module.load_state_dict(states["model_state"])
+        self.optimizer.load_state_dict(states["optimizer_state"])
 
-        if self.scheduler and checkpoint.scheduler_state:
-            self.scheduler.load_state_dict(checkpoint.scheduler_state)
+        if self.scheduler and states["scheduler_state"]:
+            self.scheduler.load_state_dict(states["scheduler_state"])
 
-        self.state = checkpoint.trainer_state
+        if checkpoint is not None:
+            self.state = checkpoint.trainer_state
 
-        obj_list = [self.state.epoch, self.state.global_step]
-        dist.broadcast_object_list(obj_list, src=0)
-        self.state.epoch = obj_list[0]
-        self.state.global_step = obj_list[1]
+        progress = torch.tensor(
+            [self.state.epoch, self.state.global_step],
+            dtype=torch.long,
+            device=self.device,
+        )
+        dist.broadcast(progress, src=0)
+        self.state.epoch, self.state.global_step = progress.tolist()
 
         logger.info(
             f"Resumed training from {self.config.resume_checkpoint} at epoch {self.state.epoch}"
         )
 
+    def _broadcast_from_main(self, obj: Any) -> Any:
+        """
+        Broadcast a nested structure of tensors from rank 0. Only the small
+        non-tensor skeleton is pickled, tensors are sent with dist.broadcast.
+        """
+        tensors: List[torch.Tensor] = []
+        skeleton = _extract_tensors(obj, tensors) if self.is_main else None
+        metas = [(t.shape, t.dtype, t.device.type) for t in tensors]
+
+        header = [skeleton, metas]
+        dist.broadcast_object_list(header, src=0)
+        skeleton, metas = header
+
+        received = []
+        for i, (shape, dtype, device_type) in enumerate(metas):
+            if self.is_main:
+                buffer = tensors[i].to(self.device)
+            else:
+                buffer = torch.empty(shape, dtype=dtype, device=self.device)
+            dist.broadcast(buffer, src=0)
+            received.append(tensors[i] if self.is_main else buffer.to(device_type))
+
+        return _restore_tensors(skeleton, received)
+
+    def _batch_to_device(self, batch: Dict[str, Any]) -> Dict[str, torch.Tensor]:
+        # Model inputs arrive packed in one pinned buffer, so a single copy suffices
+        packed = batch["packed"].to(self.device, non_blocking=True)
+        return unpack_tensors(packed, batch["packed_layout"])
+
     def train_epoch(self):
         self.model.train()
-        self.train_loader.sampler.set_epoch(self.state.epoch)
-        total_loss = 0.0
+        self.train_loader.batch_sampler.set_epoch(self.state.epoch)
+        total_loss = torch.zeros((), device=self.device)
+        finite_steps = torch.zeros((), device=self.device)
         accum_steps = 0
 
         for batch_idx, batch in enumerate(self.train_loader):
             try:
-                batch = {
-                    k: v.to(self.device) for k, v in batch.items() if torch.is_tensor(v)
-                }
-
-                with torch.autocast(device_type="cuda", dtype=torch.float16):
-                    loss, _ = self.model(
-                        text_tokens=batch["text_tokens"],
-                        audio_tokens=batch["audio_tokens"][:, :, :-1],
-                        target=batch["audio_tokens"][:, :, 1:],
-                        mask=batch["attention_mask"][:, :-1],
-                    )
+                batch = self._batch_to_device(batch)
 
-                if torch.isnan(loss) or torch.isinf(loss):
-                    logger.warning(
-                        f"NaN/Inf loss detected at batch {batch_idx}, skipping batch."
-                    )
-                    continue
+                # Only all-reduce gradients on the micro-step that ends accumulation
+                is_sync_step = (batch_idx + 1) % self.config.grad_accum_steps == 0
+                sync_context = (
+                    contextlib.nullcontext() if is_sync_step else self.model.no_sync()
+                )
+
+                with sync_context:
+                    with torch.autocast(device_type="cuda", dtype=self.amp_dtype):
+                        loss, _ = self.model(
+                            text_tokens=batch["text_tokens"],
+                            audio_tokens=batch["audio_input"],
+                            target=batch["audio_target"],
+                            mask=batch["input_mask"],
+                        )
+
+                    # Non-finite losses are masked on device to avoid a host sync per
+                    # micro-batch. Any non-finite gradient is caught at the sync step.
+                    is_finite = torch.isfinite(loss)
+                    loss = torch.where(is_finite, loss, torch.zeros_like(loss))
+
+                    scaled_loss = loss / self.config.grad_accum_steps
+                    self.scaler.scale(scaled_loss).backward()
 
-                scaled_loss = loss / self.config.grad_accum_steps
-                self.scaler.scale(scaled_loss).backward()
-                total_loss += loss.item()
+                total_loss += loss.detach()
+                finite_steps += is_finite
                 accum_steps += 1
 
-                if (batch_idx + 1) % self.config.grad_accum_steps == 0:
-                    total_loss_tensor = torch.tensor(total_loss, device=self.device)
-                    dist.all_reduce(total_loss_tensor, op=dist.ReduceOp.SUM)
+                if is_sync_step:
+                    stats = torch.stack([total_loss, finite_steps])
+                    dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+                    global_loss, global_finite_steps = stats.tolist()
 
                     if self.is_main:
-                        avg_loss = total_loss_tensor.item() / (
-                            accum_steps * dist.get_world_size()
+                        skipped = accum_steps * dist.get_world_size() - int(
+                            global_finite_steps
+                        )
+                        if skipped > 0:
+                            logger.warning(
+                                f"NaN/Inf loss detected in {skipped} micro-batches before step {self.state.global_step}"
+                            )
+                        avg_loss = (
+                            global_loss / global_finite_steps
+                            if global_finite_steps != 0
+                            else float("nan")
                         )
                         logger.info(
                             f"Epoch {self.state.epoch} Step {self.state.global_step} Batch {batch_idx + 1} Loss: {avg_loss:.4f}"
                         )
 
-                    total_loss = 0.0
+                    total_loss.zero_()
+                    finite_steps.zero_()
                     accum_steps = 0
 
                     self.scaler.unscale_(self.optimizer)
-                    clip_grad_norm_(self.model.parameters(), self.config.grad_clip_norm)
-                    self.scaler.step(self.optimizer)
+                    grad_norm = clip_grad_norm_(
+                        self.model.parameters(),
+                        self.config.grad_clip_norm,
+                        error_if_nonfinite=False,
+                        foreach=True,
+                    )
+                    # GradScaler skips non-finite steps itself when it is enabled.
+                    # Gradients are all-reduced, so every rank takes the same branch.
+                    if self.scaler.is_enabled() or torch.isfinite(grad_norm):
+                        self.scaler.step(self.optimizer)
+                    else:
+                        logger.warning(
+                            f"Non-finite gradient norm at step {self.state.global_step}, skipping optimizer step."
+                        )
                     self.scaler.update()
-                    self.optimizer.zero_grad()
+                    self.optimizer.zero_grad(set_to_none=True)
                     self.scheduler.step()
                     self.state.global_step += 1
             except Exception as e:
@@ -278,35 +436,33 @@ class DistributedTTSTrainer:
             return
 
         self.model.eval()
-        total_loss = 0.0
+        total_loss = torch.zeros((), device=self.device)
         total_samples = 0
 
         with torch.no_grad():
             for batch_idx, batch in enumerate(self.val_loader):
                 try:
-                    batch = {
-                        k: v.to(self.device)
-                        for k, v in batch.items()
-                        if torch.is_tensor(v)
-                    }
-
-                    loss, _ = self.model(
-                        text_tokens=batch["text_tokens"],
-                        audio_tokens=batch["audio_tokens"][:, :, :-1],
-                        target=batch["audio_tokens"][:, :, 1:],
-                        mask=batch["attention_mask"][:, :-1],
-                    )
+                    batch = self._batch_to_device(batch)
+
+                    with torch.autocast(device_type="cuda", dtype=self.amp_dtype):
+                        loss, _ = self.model(
+                            text_tokens=batch["text_tokens"],
+                            audio_tokens=batch["audio_input"],
+                            target=batch["audio_target"],
+                            mask=batch["input_mask"],
+                        )
 
                     num_samples = batch["text_tokens"].size(0)
-                    batch_loss = loss.item() * num_samples
-                    total_loss += batch_loss
+                    total_loss += loss.detach() * num_samples
                     total_samples += num_samples
 
                     if (
                         batch_idx + 1
                     ) % self.config.validation_epoch_logger_freq == 0 and self.is_main:
                         avg_loss_so_far = (
-                            total_loss / total_samples if total_samples != 0 else 0.0
+                            total_loss.item() / total_samples
+                            if total_samples != 0
+                            else 0.0
                         )
                         logger.info(
                             f"Validation: Batch {batch_idx + 1} Loss: {avg_loss_so_far:.4f}"
@@ -319,17 +475,17 @@ class DistributedTTSTrainer:
                     )
                     continue
 
-        total_loss_tensor = torch.tensor(total_loss, device=self.device)
-        total_samples_tensor = torch.tensor(total_samples, device=self.device)
-
-        dist.all_reduce(total_loss_tensor, op=dist.ReduceOp.SUM)
-        dist.all_reduce(total_samples_tensor, op=dist.ReduceOp.SUM)
-
-        avg_loss = (
-            total_loss_tensor.item() / total_samples_tensor.item()
-            if total_samples_tensor.item() != 0
-            else 0.0
+        # Pack loss and sample count so a single collective reduces both
+        stats = torch.stack(
+            [
+                total_loss.float(),
+                torch.tensor(float(total_samples), device=self.device),
+            ]
         )
+        dist.all_reduce(stats, op=dist.ReduceOp.SUM)
+
+        global_loss, global_samples = stats.tolist()
+        avg_loss = global_loss / global_samples if global_samples != 0 else 0.0
 
         if self.is_main:
             logger.info(f"Validation Loss: {avg_loss:.4f}")
@@ -338,16 +494,78 @@ class DistributedTTSTrainer:
                 self.save_checkpoint(best=True)
 
 
-def setup_distributed(config: TrainingConfig) -> torch.device:
+def wrap_ddp(model: torch.nn.Module, device: torch.device) -> DDP:
+    # static_graph is deliberately not set: it breaks the no_sync() micro-steps
+    # used for gradient accumulation.
+    device_ids = [device.index] if device.type == "cuda" else None
+    return DDP(
+        model,
+        device_ids=device_ids,
+        output_device=device_ids[0] if device_ids else None,
+        bucket_cap_mb=50,
+        gradient_as_bucket_view=True,
+    )
+
+
+def _to_cpu(obj: Any) -> Any:
+    if torch.is_tensor(obj):
+        # copy=True so CPU tensors such as the optimizer step count are snapshotted
+        # rather than shared with the live state the writer thread would race on
+        return obj.detach().to("cpu", non_blocking=True, copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+@dataclass
+class _TensorRef:
+    index: int
+
+
+def _extract_tensors(obj: Any, tensors: List[torch.Tensor]) -> Any:
+    if torch.is_tensor(obj):
+        tensors.append(obj)
+        return _TensorRef(len(tensors) - 1)
+    if isinstance(obj, dict):
+        return {k: _extract_tensors(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_extract_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def _restore_tensors(obj: Any, tensors: List[torch.Tensor]) -> Any:
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        return {k: _restore_tensors(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_restore_tensors(v, tensors) for v in obj)
+    return obj
+
+
+def setup_distributed(config: TrainingConfig) -> Tuple[torch.device, torch.dtype]:
     dist.init_process_group(backend=config.backend)
     local_rank = int(os.environ["LOCAL_RANK"])
     torch.cuda.set_device(local_rank)
+    torch.set_float32_matmul_precision("high")
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    torch.backends.cudnn.benchmark = True
+    # BF16 shares FP32's exponent range and needs no loss scaling. Pre-Ampere GPUs
+    # only emulate it slowly, so they fall back to FP16 with a GradScaler instead.
+    if torch.cuda.is_bf16_supported(including_emulation=False):
+        amp_dtype = torch.bfloat16
+    else:
+        logger.warning("BF16 is not supported on this GPU, falling back to FP16")
+        amp_dtype = torch.float16
     torch.manual_seed(config.seed + dist.get_rank())
-    return torch.device(f"cuda:{local_rank}")
+    return torch.device(f"cuda:{local_rank}"), amp_dtype
 
 
 def train(config: TrainingConfig):
-    device = setup_distributed(config)
+    device, amp_dtype = setup_distributed(config)
 
     dac_model = create_dac_tokenizer_model("16khz")
     dac_tokenizer = DacTokenizer(dac_model)
@@ -356,10 +574,13 @@ def train(config: TrainingConfig):
     ttsTransformerArgs = TTSTransformerArgs(
         text_vocab_size=misaki_tokenizer.vocab_size,
         audio_vocab_size=dac_tokenizer.vocab_size,
+        use_ckpt=config.activation_checkpointing,
     )
-    model = TTSTransformer(ttsTransformerArgs)
+    # Materialize weights directly on the GPU instead of building on CPU and copying
+    with torch.device(device):
+        model = TTSTransformer(ttsTransformerArgs)
 
-    trainer = DistributedTTSTrainer(config, model, device)
+    trainer = DistributedTTSTrainer(config, model, device, amp_dtype)
 
     start_epoch = trainer.state.epoch
     for epoch in range(start_epoch, config.epochs):
@@ -371,6 +592,7 @@ def train(config: TrainingConfig):
         if (epoch + 1) % config.checkpoint_freq == 0:
             trainer.save_checkpoint()
 
+    trainer.wait_for_checkpoint()
     dist.destroy_process_group()
 
 
@@ -24,6 +24,7 @@ class TTSTransformerArgs(BaseTransformerArgs):
     quantizer_max_weight: float = 1
     quantizer_min_weight: float = 0.0
     max_seqlen: int = 4096
+    use_ckpt: bool = False
 
     n_heads: int = 8
 
@@ -42,6 +43,7 @@ class TTSTransformer(BaseTransformer):
         self.dim = args.dim
         self.quantizer_max_weight = args.quantizer_max_weight
         self.quantizer_min_weight = args.quantizer_min_weight
+        self.use_ckpt = args.use_ckpt
 
         self.text_embeddings = nn.Embedding(self.text_vocab_size, self.dim)
         self.audio_embeddings = nn.ModuleList(